@@ -2,7 +2,6 @@ import os
 import logging
 from warnings import warn
 import pytest
-import tempfile
 import requests.exceptions
 from pathlib import Path
 from tempfile import mkdtemp
@@ -37,9 +36,10 @@ def cli_runner(catch_cli_exceptions):
 
 
 @pytest.fixture
-def work_dir():
-    work_dir = tempfile.mkdtemp()
-    return Path(work_dir)
+def work_dir(tmp_path):
+    # Alias for pytest's per-test temporary directory, so each test (and xdist
+    # worker) gets a fresh directory and there is nothing to clean up beforehand
+    return tmp_path
 
 
 @pytest.fixture(scope="session")
@@ -131,8 +131,22 @@ def bids_success_str():
 
 
 @pytest.fixture(scope="session")
-def bids_validator_docker():
-    dc = docker.from_env()
+def docker_client():
+    return docker.from_env()
+
+
+@pytest.fixture(scope="session")
+def bids_validator_docker(docker_client):
+    dc = docker_client
+    # Only pull the validator image if it isn't already present locally, unless a
+    # refresh has been explicitly requested
+    if not os.getenv("BIDS_VALIDATOR_REFRESH"):
+        try:
+            dc.images.get(BIDS_VALIDATOR_DOCKER)
+        except docker.errors.ImageNotFound:
+            pass
+        else:
+            return BIDS_VALIDATOR_DOCKER
     try:
         dc.images.pull(BIDS_VALIDATOR_DOCKER)
     except requests.exceptions.HTTPError:
@@ -142,28 +156,30 @@ def bids_validator_docker():
 
 @pytest.fixture(scope="session")
 def bids_validator_app_image(
-    bids_validator_app_script, bids_validator_docker, build_cache_dir
+    bids_validator_app_script, bids_validator_docker, build_cache_dir, docker_client
 ):
     return build_app_image(
         BIDS_VALIDATOR_APP_IMAGE,
         bids_validator_app_script,
         build_cache_dir,
         base_image=bids_validator_docker,
+        docker_client=docker_client,
     )
 
 
 @pytest.fixture(scope="session")
-def mock_bids_app_image(mock_bids_app_script, build_cache_dir):
+def mock_bids_app_image(mock_bids_app_script, build_cache_dir, docker_client):
     return build_app_image(
         MOCK_BIDS_APP_IMAGE,
         mock_bids_app_script,
         build_cache_dir,
         base_image=Pydra2AppImage().reference,
+        docker_client=docker_client,
     )
 
 
-def build_app_image(tag_name, script, build_cache_dir, base_image):
-    dc = docker.from_env()
+def build_app_image(tag_name, script, build_cache_dir, base_image, docker_client):
+    dc = docker_client
 
     # Create executable that runs validator then produces some mock output
     # files
@@ -255,6 +271,14 @@ if os.getenv("_PYTEST_RAISE", "0") != "0":
     def pytest_internalerror(excinfo):
         raise excinfo.value
 
+    @pytest.hookimpl(tryfirst=True)
+    def pytest_cmdline_main(config):
+        # The hooks above need to raise in the main process for the IDE to break
+        # on them, so disable any parallel xdist workers requested with '-n' (runs
+        # before xdist's own hook as conftest plugins are registered later)
+        if hasattr(config.option, "numprocesses"):
+            config.option.numprocesses = 0
+
     CATCH_CLI_EXCEPTIONS = False
 else:
     CATCH_CLI_EXCEPTIONS = True
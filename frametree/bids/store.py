@@ -1,9 +1,13 @@
 from __future__ import annotations
+import os
 import typing as ty
 import json
 import re
+import math
+import secrets
 import logging
-from operator import itemgetter
+import functools
+from operator import itemgetter, attrgetter
 import attrs
 import jq
 from pathlib import Path
@@ -18,10 +22,15 @@ from frametree.common import Clinical
 from frametree.core.entry import DataEntry
 from frametree.core.row import DataRow
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 logger = logging.getLogger("frametree")
 
 
-@attrs.define
+@attrs.frozen
 class JsonEdit:
 
     path: str
@@ -32,6 +41,49 @@ class JsonEdit:
     # exception that '{a_column_name}' will be substituted by the file path of
     # the item matching the column ('{' and '}' need to be escaped by duplicating,
     # i.e. '{{' and '}}').
+    _path_prefix: str = attrs.field(init=False, repr=False, eq=False)
+    # the literal leading component of 'path' (e.g. 'anat/' for 'anat/T.*w') if
+    # it has one, so files in other data types can be ruled out with a string
+    # comparison before the regular expression is applied
+    _tail_re: re.Pattern = attrs.field(init=False, repr=False, eq=False)
+    # the compiled remainder of 'path' after the literal prefix, compiled once on
+    # construction so it isn't recompiled for every file that is written (the class
+    # is frozen so these derived fields can't go stale)
+
+    LITERAL_RE = re.compile(r"[\w\-]+")
+
+    @_path_prefix.default
+    def _path_prefix_default(self) -> str:
+        head, sep, tail = self.path.partition("/")
+        if (
+            sep
+            and self.LITERAL_RE.fullmatch(head)
+            and "|" not in self.path  # top-level alternation would span the '/'
+            and not tail.startswith(("?", "*", "+", "{"))  # quantifies the '/'
+        ):
+            return head + sep
+        return ""
+
+    @_tail_re.default
+    def _tail_re_default(self) -> re.Pattern:
+        return re.compile(self.path[len(self._path_prefix) :])
+
+    def matches(self, entry_path: str) -> bool:
+        """Whether the edit should be applied to the entry at the given path
+
+        Parameters
+        ----------
+        entry_path : str
+            the path of the entry relative to its row, e.g. 'anat/T1w'
+
+        Returns
+        -------
+        bool
+            whether 'path' matches the start of the entry path
+        """
+        return entry_path.startswith(self._path_prefix) and bool(
+            self._tail_re.match(entry_path, len(self._path_prefix))
+        )
 
     @classmethod
     def attr_converter(cls, json_edits: list) -> list:
@@ -107,17 +159,19 @@ class Bids(LocalStore):
                 for line in lines[1:]:
                     dct = dict(zip(participant_keys, line.split("\t")))
                     participants[dct.pop("participant_id")[len("sub-") :]] = dct
-        for subject_dir in root_dir.iterdir():
-            if not subject_dir.name.startswith("sub-"):
-                continue
+        # Only list the 'sub-*' and 'sub-*/ses-*' directories rather than walking
+        # the whole dataset, which can include large 'derivatives' or 'sourcedata'
+        # trees
+        for subject_dir in self._scan_dirs(root_dir, "sub-"):
             subject_id = subject_dir.name[len("sub-") :]
             if "group" in tree.frameset.hierarchy:
                 tree_path = [participants[subject_id]["group"]]
             else:
                 tree_path = []
             tree_path.append(subject_id)
-            if any(d.name.startswith("ses-") for d in subject_dir.iterdir()):
-                for sess_dir in subject_dir.iterdir():
+            sess_dirs = self._scan_dirs(subject_dir.path, "ses-")
+            if sess_dirs:
+                for sess_dir in sess_dirs:
                     visit_id = sess_dir.name[len("ses-") :]
                     tree.add_leaf(tree_path + [visit_id])
             else:
@@ -227,9 +281,13 @@ class Bids(LocalStore):
         Inserts or updates a fileset in the store
         """
         fspath = self._fileset_fspath(entry)
-        # Create target directory if it doesn't exist already
+        # Create target directory if it doesn't exist already, and hard-link the
+        # files into the dataset where possible (i.e. when they are on the same
+        # file-system) to avoid duplicating the data. Symlinks aren't used as the
+        # dataset needs to be self-contained (e.g. to be mounted into app containers)
         copied_fileset = fileset.copy(
             dest_dir=fspath.parent,
+            mode=FileSet.CopyMode.hardlink_or_copy,
             new_stem=fspath.name[: -len(fileset.ext)],
             make_dirs=True,
             overwrite=entry.is_derivative,
@@ -252,21 +310,16 @@ class Bids(LocalStore):
         self.update_json(fspath, key, field.primitive(field))
 
     def get_fileset_provenance(self, entry: DataEntry) -> ty.Dict[str, ty.Any]:
-        with open(self._fileset_prov_fspath(entry)) as f:
-            provenance = json.load(f)
-        return provenance
+        return load_json(self._fileset_prov_fspath(entry))
 
     def put_fileset_provenance(
         self, provenance: ty.Dict[str, ty.Any], entry: DataEntry
     ):
-        with open(self._fileset_prov_fspath(entry), "w") as f:
-            json.dump(provenance, f)
+        dump_json(provenance, self._fileset_prov_fspath(entry))
 
     def get_field_provenance(self, entry: DataEntry) -> ty.Dict[str, ty.Any]:
         fspath, key = self._fields_prov_fspath_and_key(entry)
-        with open(fspath) as f:
-            fields_provenance = json.load(f)
-        return fields_provenance[key]
+        return load_json(fspath)[key]
 
     def put_field_provenance(self, provenance: ty.Dict[str, ty.Any], entry: DataEntry):
         fspath, key = self._fields_prov_fspath_and_key(entry)
@@ -404,6 +457,28 @@ class Bids(LocalStore):
             with open(dataset.root_dir / "participants.json", "w") as f:
                 json.dump(participants_desc, f)
 
+    @staticmethod
+    def _scan_dirs(parent: ty.Union[str, Path], prefix: str) -> ty.List[os.DirEntry]:
+        """Lists the sub-directories of a directory that start with the given prefix.
+        Uses `os.scandir` so that the file-type information returned with the
+        directory listing is used instead of requiring a separate stat() per entry
+
+        Parameters
+        ----------
+        parent : str or Path
+            the directory to list
+        prefix : str
+            the prefix the names of the sub-directories need to start with, e.g. 'sub-'
+
+        Returns
+        -------
+        list[os.DirEntry]
+            the matching sub-directories, sorted by name
+        """
+        with os.scandir(parent) as it:
+            dirs = [e for e in it if e.name.startswith(prefix) and e.is_dir()]
+        return sorted(dirs, key=attrgetter("name"))
+
     def _fileset_fspath(self, entry: DataEntry) -> Path:
         return Path(entry.row.frameset.id) / entry.uri
 
@@ -428,36 +503,47 @@ class Bids(LocalStore):
         fspath : str
             Path of the JSON to potentially edit
         """
-        with open(nifti_x.json_file) as f:
-            json_dict = json.load(f)
-
+        # Work out which edits apply to the file before touching the side-car, so
+        # it doesn't need to be read, or rewritten, when there is nothing to do
+        task_match = re.match(r".*/task=([^/]+)", entry.path)
+        jedits = [j for j in self.json_edits if j.matches(entry.path)]
+        if not (task_match or jedits):
+            return
+        json_fspath = nifti_x.json_file.fspath
+        json_dict = load_json(json_fspath)
+        edited = False
         # Ensure there is a value for TaskName for files that include 'task-taskname'
         # in their file path
-        if match := re.match(r".*/task=([^/]+)", entry.path):
-            if "TaskName" not in json_dict:
-                json_dict["TaskName"] = match.group(1)
-        # Get dictionary containing file paths for all items in the same row
-        # as the file-set so they can be used in the edits using Python
-        # string templating
-        col_fspaths = {}
-        for cell in entry.row.cells():
-            if cell.is_empty:
-                cell_uri = self.fileset_uri(cell.column.path, cell.datatype, entry.row)
-            else:
-                cell_uri = cell.entry.uri
-            try:
-                col_fspaths[cell.column.name] = Path(cell_uri).relative_to(
-                    self._rel_row_path(entry.row)
-                )
-            except ValueError:
-                pass
-        for jedit in self.json_edits:
-            jq_expr = jedit.jq_expr.format(**col_fspaths)  # subst col file paths
-            if re.match(jedit.path, entry.path):
-                json_dict = jq.compile(jq_expr).input(json_dict).first()
-        # Write dictionary back to file if it has been loaded
-        with open(nifti_x.json_file, "w") as f:
-            json.dump(json_dict, f)
+        if task_match and "TaskName" not in json_dict:
+            json_dict["TaskName"] = task_match.group(1)
+            edited = True
+        if jedits:
+            # Get dictionary containing file paths for all items in the same row
+            # as the file-set so they can be used in the edits using Python
+            # string templating
+            col_fspaths = {}
+            for cell in entry.row.cells():
+                if cell.is_empty:
+                    cell_uri = self.fileset_uri(
+                        cell.column.path, cell.datatype, entry.row
+                    )
+                else:
+                    cell_uri = cell.entry.uri
+                try:
+                    col_fspaths[cell.column.name] = Path(cell_uri).relative_to(
+                        self._rel_row_path(entry.row)
+                    )
+                except ValueError:
+                    pass
+            for jedit in jedits:
+                jq_expr = jedit.jq_expr.format(**col_fspaths)  # subst col file paths
+                json_dict = compile_jq(jq_expr).input(json_dict).first()
+            edited = True
+        # Write dictionary back to file if it has been edited. dump_json replaces
+        # the file rather than writing into it, so if the side-car is hard-linked to
+        # the source file the source isn't edited too
+        if edited:
+            dump_json(json_dict, json_fspath)
 
     @classmethod
     def _extract_entities(cls, relpath: Path) -> ty.Tuple[str, ty.List[str], str]:
@@ -562,6 +648,142 @@ class Bids(LocalStore):
         return Path(dataset_id) / "derivatives" / name / "definition.yaml"
 
 
+@functools.lru_cache(maxsize=256)
+def compile_jq(jq_expr: str) -> jq._Program:
+    """Compiles a JQ expression, caching the compiled program so it can be reused
+    across all the side-cars it is applied to. The cache is bounded as expressions
+    that reference column file-paths differ between rows (the paths contain the
+    subject/session IDs), and would otherwise accumulate without limit
+
+    Parameters
+    ----------
+    jq_expr : str
+        the JQ expression to compile (after the column file-paths have been
+        substituted in)
+
+    Returns
+    -------
+    jq._Program
+        the compiled JQ program
+    """
+    return jq.compile(jq_expr)
+
+
+def load_json(fspath: Path) -> ty.Any:
+    """Loads a JSON file, using orjson to parse it if it is installed
+
+    Parameters
+    ----------
+    fspath : Path
+        path to the JSON file
+
+    Returns
+    -------
+    Any
+        the decoded JSON document
+    """
+    with open(fspath, "rb") as f:
+        contents = f.read()
+    # orjson decodes integers outside of the 64-bit range as floats, so leave any
+    # documents that may contain them (i.e. with long runs of digits) to the stdlib
+    if orjson is not None and not _may_contain_long_int(contents):
+        try:
+            return orjson.loads(contents)
+        except orjson.JSONDecodeError:
+            pass  # fall back to the more lenient stdlib parser (e.g. for NaN values)
+    return json.loads(contents)
+
+
+def _may_contain_long_int(contents: bytes) -> bool:
+    """Whether a JSON document contains a run of 19 or more digits that isn't the
+    fractional part of a float, i.e. a potential integer outside of the 64-bit
+    range. Uses C-level bytes methods only, as a regex scan is slower than parsing
+    the document with orjson"""
+    runs = contents.translate(DIGIT_RUNS_TABLE)
+    return LONG_INT_RUN in runs or runs.startswith(LONG_INT_RUN[1:])
+
+
+# Maps digits to "0", decimal points to "." and everything else to " "
+DIGIT_RUNS_TABLE = bytes(
+    ord("0") if chr(i) in "0123456789" else ord(".") if i == ord(".") else ord(" ")
+    for i in range(256)
+)
+LONG_INT_RUN = b" " + b"0" * 19
+
+
+def dump_json(obj: ty.Any, fspath: Path):
+    """Writes an object to a JSON file, using orjson to serialise it if it is
+    installed. The document is written to a temporary file alongside the target,
+    which then replaces it, so a failure part way through doesn't leave the file
+    truncated or missing, and any hard-links to the original file are broken
+
+    Parameters
+    ----------
+    obj : Any
+        the object to serialise
+    fspath : Path
+        path of the JSON file to write
+    """
+    contents = None
+    if orjson is not None:
+        try:
+            contents = orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+        except orjson.JSONEncodeError:
+            pass  # e.g. integers larger than 64 bits, fall back to the stdlib
+        else:
+            # orjson writes non-finite floats as null, so use the stdlib for those to
+            # preserve the NaN/Infinity values read back by load_json. Only walk the
+            # object if there is a null in the output, as the walk is slower than
+            # the serialisation itself
+            if b"null" in contents and _contains_non_finite(obj):
+                contents = None
+    if contents is None:
+        contents = json.dumps(obj).encode()
+    fspath = Path(fspath)
+    tmp_fspath = fspath.with_name(f".{fspath.name}.{secrets.token_hex(4)}.tmp")
+    # The document is already serialised, so write it straight to the file
+    # descriptor instead of going through Python's buffered file objects
+    fd = os.open(tmp_fspath, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    try:
+        try:
+            view = memoryview(contents)
+            while view:
+                view = view[os.write(fd, view) :]
+        finally:
+            os.close(fd)
+        os.replace(tmp_fspath, fspath)
+    except BaseException:
+        tmp_fspath.unlink(missing_ok=True)
+        raise
+
+
+def _contains_non_finite(obj: ty.Any) -> bool:
+    """Whether a decoded JSON document contains any NaN or infinite floats. Walks the
+    document iteratively, checking for the exact JSON types before falling back to
+    isinstance to catch subclasses, as recursing is slower than serialising it"""
+    stack = [obj]
+    while stack:
+        item = stack.pop()
+        item_type = type(item)
+        if item_type is float:
+            if not math.isfinite(item):
+                return True
+        elif item_type is dict:
+            stack.extend(item.values())
+        elif item_type is list or item_type is tuple:
+            stack.extend(item)
+        elif item_type is str or item_type is int or item is None:
+            pass
+        elif isinstance(item, float):
+            if not math.isfinite(item):
+                return True
+        elif isinstance(item, dict):
+            stack.extend(item.values())
+        elif isinstance(item, (list, tuple)):
+            stack.extend(item)
+    return False
+
+
 def outputs_converter(outputs):
     """Sets the path of an output to '' if not provided or None"""
     return [o[:2] + ("",) if len(o) < 3 or o[2] is None else o for o in outputs]
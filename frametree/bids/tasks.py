@@ -63,6 +63,7 @@ def bids_app(
     app_output_dir: ty.Optional[Path] = None,
     app_work_dir: ty.Optional[Path] = None,
     json_edits: ty.List[ty.Tuple[str, str]] = None,
+    pull_policy: ty.Optional[str] = None,
 ) -> Workflow:
     """Creates a Pydra workflow which takes file inputs, maps them to
     a BIDS dataset, executes a BIDS app, and then extracts the
@@ -111,12 +112,29 @@ def bids_app(
         Ad-hoc edits to JSON side-cars that are fixed during the configuration
         of the app, i.e. not passed as an input. Input JSON edits are appended
         to these fixed
+    pull_policy: str, optional
+        the policy used to pull the container image before it is run, one of
+        'always', 'missing' or 'never' (i.e. passed to `docker run --pull`). By
+        default the container engine's default is used. Setting it to 'never' avoids
+        checking the registry for updates to an image that is already present. Can
+        only be provided along with `container_image`
 
     Returns
     -------
     pydra.Workflow
         A Pydra workflow
     """
+    if pull_policy is not None:
+        if container_image is None:
+            raise ValueError(
+                f"A pull policy ('{pull_policy}') can only be provided along with a "
+                "container image"
+            )
+        if pull_policy not in PULL_POLICIES:
+            raise ValueError(
+                f"Unrecognised pull policy '{pull_policy}', should be one of "
+                + ", ".join(f"'{p}'" for p in PULL_POLICIES)
+            )
     if parameters is None:
         parameters = {}
     if app_output_dir is None:
@@ -228,7 +246,10 @@ def bids_app(
         app_output_path = str(app_output_dir)
         environment = Native()
     else:
-        environment = Docker(container_image)
+        xargs = []
+        if pull_policy is not None:
+            xargs.append(f"--pull={pull_policy}")
+        environment = Docker(container_image, xargs=xargs)
         app_output_path = CONTAINER_DERIV_PATH
 
     if row_frequency == Clinical.session:
@@ -300,6 +321,8 @@ CONTAINER_DATASET_PATH = "/frametree_bids_dataset"
 
 DEFAULT_BIDS_ID = "DEFAULT"
 
+PULL_POLICIES = ("always", "missing", "never")
+
 
 # @mark.task
 # @mark.annotate({"return": {"out": str, "no_prefix": str}})
@@ -1,19 +1,21 @@
+import os
 import typing as ty
 import json
+import re
 import itertools
 from pathlib import Path
-from warnings import warn
-import requests.exceptions
 import nibabel as nb
-import numpy.random
+import numpy
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
+import attrs
 import pytest
-import docker
 from fileformats.medimage import NiftiX
 from frametree.core import __version__
 from frametree.common import Clinical
-from frametree.bids.store import Bids
+from frametree.bids import store
+from frametree.bids.store import Bids, JsonEdit, dump_json, load_json
 
 
 MOCK_BIDS_APP_NAME = "mockapp"
@@ -21,12 +23,50 @@ MOCK_README = "A dummy readme\n" * 100
 MOCK_AUTHORS = ["Dumm Y. Author", "Another D. Author"]
 
 
-def test_bids_roundtrip(bids_validator_docker, bids_success_str, work_dir):
+_SHAPE = (10, 10, 10)
+_ZOOMS = (1.0, 1.0, 1.0)  # voxel size
+_AFF = numpy.diag([1, 2, 3, 1]).astype(numpy.float64)
+
+
+def _build_hdr() -> nb.Nifti1Header:
+    hdr = nb.Nifti1Header()
+    hdr.set_data_shape(_SHAPE)
+    hdr.set_data_dtype(numpy.int16)
+    hdr.set_zooms(_ZOOMS)
+    hdr.set_xyzt_units(2)  # millimeters
+    hdr.set_qform(_AFF)
+    return hdr
+
+
+# Template header for dummy Nifti files, built once at import and copied when used
+_TEMPLATE_HDR = _build_hdr()
+
+
+def _make_dummy_nifti(fspath: Path) -> Path:
+    """Saves a dummy Nifti file (to satisfy BIDS parsers) at the given path. The
+    known affine is passed directly rather than being inferred from the header"""
+    nb.save(
+        nb.Nifti1Image(
+            numpy.zeros(_SHAPE, dtype=numpy.int16), _AFF, header=_TEMPLATE_HDR.copy()
+        ),
+        fspath,
+    )
+    return fspath
+
+
+@pytest.fixture(scope="session")
+def dummy_nifti_file(tmp_path_factory):
+    """A dummy Nifti file to satisfy BIDS parsers, which is only created once and
+    then copied into place by the tests that need it"""
+    return _make_dummy_nifti(tmp_path_factory.mktemp("dummy-nifti") / "dummy.nii")
+
+
+@pytest.mark.xdist_group(name="docker")
+def test_bids_roundtrip(request, bids_success_str, dummy_nifti_file, work_dir):
 
     path = work_dir / "bids-dataset"
     dataset_name = "adataset"
 
-    shutil.rmtree(path, ignore_errors=True)
     dataset = Bids().create_dataset(
         id=path,
         name=dataset_name,
@@ -63,41 +103,45 @@ def test_bids_roundtrip(bids_validator_docker, bids_success_str, work_dir):
     # dummy_nifti_gz = dummy_nifti + '.gz'
     dummy_json = work_dir / "t1w.json"
 
-    # Create a random Nifti file to satisfy BIDS parsers
-    hdr = nb.Nifti1Header()
-    hdr.set_data_shape((10, 10, 10))
-    hdr.set_zooms((1.0, 1.0, 1.0))  # set voxel size
-    hdr.set_xyzt_units(2)  # millimeters
-    hdr.set_qform(numpy.diag([1, 2, 3, 1]))
-    nb.save(
-        nb.Nifti1Image(
-            numpy.random.randint(0, 1, size=[10, 10, 10]),
-            hdr.get_best_affine(),
-            header=hdr,
-        ),
-        dummy_nifti,
-    )
+    shutil.copyfile(dummy_nifti_file, dummy_nifti)
 
     with open(dummy_json, "w") as f:
         json.dump({"test": "json-file"}, f)
 
-    for row in dataset.rows(frequency="session"):
+    def put_t1w(row):
         row["t1w"] = (dummy_nifti, dummy_json)
 
-    # Full dataset validation using dockerized validator
-    dc = docker.from_env()
-    try:
-        dc.images.pull(bids_validator_docker)
-    except requests.exceptions.HTTPError:
-        warn("No internet connection, so couldn't download latest BIDS validator")
-    result = dc.containers.run(
-        bids_validator_docker,
-        "/data",
-        volumes=[f"{path}:/data:ro"],
-        remove=True,
-        stderr=True,
-    ).decode("utf-8")
-    assert bids_success_str in result
+    # The copies into each session are independent and I/O bound so they can be
+    # overlapped. Note that each put still enters 'store.connection', whose nesting
+    # depth isn't thread-safe, so this relies on the local Bids store not needing a
+    # connection (its connect/disconnect are no-ops). Entering the connection here
+    # first just ensures the workers never trigger a connect/disconnect themselves
+    with dataset.store.connection, ThreadPoolExecutor() as executor:
+        list(executor.map(put_t1w, dataset.rows(frequency="session")))
+
+    # Unedited files are hard-linked into the dataset rather than copied
+    for row in dataset.rows(frequency="session"):
+        assert os.path.samefile(row["t1w"].fspath, dummy_nifti)
+        assert os.path.samefile(row["t1w"].json_file, dummy_json)
+
+    # Full dataset validation using dockerized validator (the image is pulled by
+    # the 'bids_validator_docker' fixture if required). Can be skipped by setting
+    # $SKIP_BIDS_VALIDATOR to only check the Python-side roundtrip, in which case
+    # the Docker fixtures aren't requested at all
+    if not os.getenv("SKIP_BIDS_VALIDATOR"):
+        docker_client = request.getfixturevalue("docker_client")
+        result = docker_client.containers.run(
+            request.getfixturevalue("bids_validator_docker"),
+            "/data",
+            volumes=[f"{path}:/data:ro"],
+            # The validator only needs to read the mounted dataset, so skip setting
+            # up container networking and keep its scratch files in memory
+            network_disabled=True,
+            tmpfs={"/tmp": "rw,size=64m"},
+            remove=True,
+            stderr=True,
+        ).decode("utf-8")
+        assert bids_success_str in result
 
     reloaded = Bids().load_frameset(id=path, name=dataset_name)
     reloaded.add_sink(
@@ -108,19 +152,40 @@ def test_bids_roundtrip(bids_validator_docker, bids_success_str, work_dir):
     assert dataset == reloaded
 
 
-@dataclass
+def test_bids_populate_tree(work_dir: Path):
+
+    path = work_dir / "bids-dataset"
+    Bids().create_dataset(
+        id=path,
+        name="adataset",
+        hierarchy=["subject", "visit"],
+        leaves=[("01", "1"), ("01", "2"), ("02", "1")],
+    )
+    # Entries that aren't subject or session directories shouldn't become rows
+    (path / "sub-01" / "anat").mkdir()
+    (path / "sub-01" / "sub-01_sessions.tsv").write_text("session_id\nses-1\nses-2\n")
+    (path / "sub-03_notes.txt").write_text("not a subject directory")
+
+    reloaded = Bids().load_frameset(id=path, name="adataset")
+    assert sorted(
+        (row.frequency_id("subject"), row.frequency_id("visit"))
+        for row in reloaded.rows(frequency="session")
+    ) == [("01", "1"), ("01", "2"), ("02", "1")]
+
+
+@dataclass(frozen=True)
 class SourceNiftiXBlueprint:
     """The blueprint for the source nifti files"""
 
     path: str  # BIDS path for Nift
-    orig_side_car: dict
-    edited_side_car: dict
+    orig_side_car: ty.Mapping[str, ty.Any]
+    edited_side_car: ty.Mapping[str, ty.Any]
 
 
-@dataclass
+@dataclass(frozen=True)
 class JsonEditBlueprint:
 
-    source_niftis: ty.Dict[str, SourceNiftiXBlueprint]
+    source_niftis: ty.Mapping[str, SourceNiftiXBlueprint]
     path_re: str  # regular expression for the paths to edit
     jq_script: str  # jq script
 
@@ -182,14 +247,15 @@ def json_edit_blueprint(request):
     return JSON_EDIT_TESTS[request.param]
 
 
-def test_bids_json_edit(json_edit_blueprint: JsonEditBlueprint, work_dir: Path):
+def test_bids_json_edit(
+    json_edit_blueprint: JsonEditBlueprint, dummy_nifti_file: Path, work_dir: Path
+):
 
     bp = json_edit_blueprint  # shorten name
 
     path = work_dir / "bids-dataset"
     name = "bids-dataset"
 
-    shutil.rmtree(path, ignore_errors=True)
     dataset = Bids(json_edits=[(bp.path_re, bp.jq_script)],).create_dataset(
         id=path,
         name=name,
@@ -211,30 +277,21 @@ def test_bids_json_edit(json_edit_blueprint: JsonEditBlueprint, work_dir: Path):
     for sf_name, sf_bp in bp.source_niftis.items():
         dataset.add_sink(sf_name, datatype=NiftiX, path=sf_bp.path)
 
-        nifti_fspath = work_dir / (sf_name + ".nii")
-        # dummy_nifti_gz = dummy_nifti + '.gz'
-        json_fspath = work_dir / (sf_name + ".json")
-
-        # Create a random Nifti file to satisfy BIDS parsers
-        hdr = nb.Nifti1Header()
-        hdr.set_data_shape((10, 10, 10))
-        hdr.set_zooms((1.0, 1.0, 1.0))  # set voxel size
-        hdr.set_xyzt_units(2)  # millimeters
-        hdr.set_qform(numpy.diag([1, 2, 3, 1]))
-        nb.save(
-            nb.Nifti1Image(
-                numpy.random.randint(0, 1, size=[10, 10, 10]),
-                hdr.get_best_affine(),
-                header=hdr,
-            ),
-            nifti_fspath,
-        )
+    # Write all the items within a single store connection
+    with dataset.store.connection:
+        for sf_name, sf_bp in bp.source_niftis.items():
+
+            nifti_fspath = work_dir / (sf_name + ".nii")
+            # dummy_nifti_gz = dummy_nifti + '.gz'
+            json_fspath = work_dir / (sf_name + ".json")
 
-        with open(json_fspath, "w") as f:
-            json.dump(sf_bp.orig_side_car, f)
+            shutil.copyfile(dummy_nifti_file, nifti_fspath)
 
-        # Get single item in dataset
-        dataset[sf_name]["1"] = (nifti_fspath, json_fspath)
+            with open(json_fspath, "w") as f:
+                json.dump(sf_bp.orig_side_car, f)
+
+            # Get single item in dataset
+            dataset[sf_name]["1"] = (nifti_fspath, json_fspath)
 
     # Check edited JSON matches reference
     for sf_name, sf_bp in bp.source_niftis.items():
@@ -244,3 +301,74 @@ def test_bids_json_edit(json_edit_blueprint: JsonEditBlueprint, work_dir: Path):
             saved_dict = json.load(f)
 
         assert saved_dict == sf_bp.edited_side_car
+
+        # Check that the source side-car wasn't edited along with the copy
+        with open(work_dir / (sf_name + ".json")) as f:
+            assert json.load(f) == sf_bp.orig_side_car
+
+
+@pytest.mark.parametrize(
+    "path_re", ["anat/T.*w", "fmap/.*", "func/bold|anat/T1w", "anat/?T1w", ".*bold"]
+)
+def test_json_edit_matches(path_re: str):
+    """Check that splitting off the literal prefix of the path doesn't change which
+    entry paths are matched"""
+    jedit = JsonEdit(path_re, ".")
+    for entry_path in [
+        "anat/T1w",
+        "anat/T2w/acq=highres",
+        "anatT1w",
+        "fmap/magnitude1",
+        "func/bold/task=rest",
+    ]:
+        assert jedit.matches(entry_path) == bool(re.match(path_re, entry_path))
+    # The split prefix/regex are derived on construction so the path can't change
+    with pytest.raises(attrs.exceptions.FrozenInstanceError):
+        jedit.path = "func/.*"
+
+
+@pytest.fixture(params=["orjson", "stdlib"])
+def json_backend(request, monkeypatch):
+    """Runs the test with both the orjson and stdlib JSON backends of the store"""
+    if request.param == "orjson":
+        pytest.importorskip("orjson")
+    else:
+        monkeypatch.setattr(store, "orjson", None)
+    return request.param
+
+
+@pytest.mark.parametrize(
+    "obj",
+    [
+        {"a": {"b": 1.5, "c": [2, 4, 6]}, "IntendedFor": "func/bold.nii"},
+        {"RepetitionTime": float("nan"), "Limits": [float("-inf"), float("inf")]},
+        {"BigInt": 2**70, "NegBigInt": [-(2**63) - 1]},
+        {"Precise": 0.00012345678901234567, "WithNull": None},
+        {1: "non-str key"},
+    ],
+)
+def test_json_roundtrip(obj: dict, json_backend: str, work_dir: Path):
+    fspath = work_dir / "side-car.json"
+    dump_json(obj, fspath)
+    expected = json.loads(json.dumps(obj))  # as the stdlib would write/read it
+    # NaN != NaN so compare the reserialised forms
+    assert json.dumps(load_json(fspath)) == json.dumps(expected)
+
+
+def test_dump_json_replaces_file(json_backend: str, work_dir: Path):
+    """Check that dump_json breaks hard-links to the original file and leaves it
+    untouched if the object can't be serialised"""
+    src_fspath = work_dir / "source.json"
+    fspath = work_dir / "side-car.json"
+    src_fspath.write_text('{"a": 1}')
+    os.link(src_fspath, fspath)
+    dump_json({"a": 2}, fspath)
+    assert load_json(fspath) == {"a": 2}
+    assert load_json(src_fspath) == {"a": 1}
+    with pytest.raises(TypeError):
+        dump_json({"a": object()}, fspath)
+    assert load_json(fspath) == {"a": 2}
+    assert sorted(p.name for p in work_dir.iterdir()) == [
+        "side-car.json",
+        "source.json",
+    ]
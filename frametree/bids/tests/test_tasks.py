@@ -1,12 +1,12 @@
 import os
 import stat
 from pathlib import Path
-import shutil
 import pytest
 from fileformats.medimage import NiftiGzX, NiftiGzXBvec
 from frametree.bids.tasks import bids_app, BidsInput, BidsOutput
 from fileformats.text import Plain as Text
 from fileformats.generic import Directory
+from pydra.engine.environments import Docker
 
 
 MOCK_BIDS_APP_NAME = "mockapp"
@@ -25,6 +25,7 @@ BIDS_OUTPUTS = [
 ]
 
 
+@pytest.mark.xdist_group(name="docker")
 @pytest.mark.xfail(reason="Need to convert this to new environment syntax")
 def test_bids_app_docker(
     bids_validator_app_image: str, nifti_sample_dir: Path, work_dir: Path
@@ -34,12 +35,11 @@ def test_bids_app_docker(
 
     bids_dir = work_dir / "bids"
 
-    shutil.rmtree(bids_dir, ignore_errors=True)
-
     task = bids_app(
         name=MOCK_BIDS_APP_NAME,
         container_image=bids_validator_app_image,
         executable=None,  # uses entrypoint
+        pull_policy="never",  # image is built locally by the fixture
         inputs=BIDS_INPUTS,
         outputs=BIDS_OUTPUTS,
         dataset=bids_dir,
@@ -84,11 +84,34 @@ def test_bids_app_naked(
             *inpt.path.split("/")
         ).with_suffix(inpt.datatype.ext)
 
-    bids_dir = work_dir / "bids"
-
-    shutil.rmtree(bids_dir, ignore_errors=True)
-
     result = task(plugin="serial", **kwargs)
 
     for output in BIDS_OUTPUTS:
         assert Path(getattr(result.output, output.name)).exists()
+
+
+def test_bids_app_pull_policy(work_dir: Path):
+
+    kwargs = {
+        "name": MOCK_BIDS_APP_NAME,
+        "inputs": BIDS_INPUTS,
+        "outputs": BIDS_OUTPUTS,
+        "app_output_dir": work_dir / "output",
+    }
+
+    with pytest.raises(ValueError, match="Unrecognised pull policy 'bogus'"):
+        bids_app(container_image="img", pull_policy="bogus", **kwargs)
+
+    with pytest.raises(ValueError, match="only be provided along with a container"):
+        bids_app(pull_policy="never", **kwargs)
+
+    wf = bids_app(
+        container_image="img",
+        pull_policy="never",
+        dataset=work_dir / "bids",
+        **kwargs,
+    )
+    environment = wf.bids_app.environment
+    assert isinstance(environment, Docker)
+    assert environment.image == "img"
+    assert environment.xargs == ["--pull=never"]